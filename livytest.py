@@ -1,17 +1,163 @@
 from botocore import crt
 import requests 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 from botocore.awsrequest import AWSRequest
 import botocore.session
-import json, pprint, textwrap
+from botocore.exceptions import NoCredentialsError
+import json, textwrap
+from dataclasses import dataclass
+from functools import cached_property
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import time
+import random
 import logging
+import socket
 import sys
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data):
+    """解析JSON，优先使用orjson"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    """序列化为紧凑的UTF-8 JSON字节串，优先使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _json_dumps_pretty(obj):
+    """格式化输出JSON，优先使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode('utf-8')
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
 
 # 设置基本日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('emr-serverless')
 
+# 进程内共享的botocore会话，首次创建客户端时初始化，凭证提供链只解析一次
+_BOTOCORE_SESSION = None
+
+# 按区域共享的签名器，各客户端实例复用同一份凭证和签名密钥: region -> signer
+_SIGNERS = {}
+_SIGNERS_LOCK = threading.Lock()
+
+
+def _get_signer(region):
+    """获取指定区域共享的SigV4签名器，获取凭证失败时抛出异常且不缓存"""
+    global _BOTOCORE_SESSION
+    with _SIGNERS_LOCK:
+        signer = _SIGNERS.get(region)
+        if signer is None:
+            if _BOTOCORE_SESSION is None:
+                _BOTOCORE_SESSION = botocore.session.Session()
+            credentials = _BOTOCORE_SESSION.get_credentials()
+            if credentials is None:
+                raise NoCredentialsError()
+            signer = crt.auth.CrtS3SigV4Auth(credentials, 'emr-serverless', region)
+            _SIGNERS[region] = signer
+        return signer
+
+
+# 开启TCP keepalive，空闲30秒后每10秒探测一次，连续3次失败后断开
+_KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+] + [
+    (socket.IPPROTO_TCP, getattr(socket, name), value)
+    for name, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3))
+    if hasattr(socket, name)
+]
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """开启TCP keepalive的连接池适配器，避免轮询间隔较长时连接被NAT或负载均衡器静默断开"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', _KEEPALIVE_SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+
+
+class ThrottleAwareRetry(Retry):
+    """
+    在urllib3层重试429响应前通知客户端，以便限流期间不再发送对冲请求
+    
+    POST请求发出后的读取错误不重试，此时服务端可能已经创建了会话或开始执行语句。
+    重试复用同一签名，因此限制Retry-After的最长等待时间，使签名(缓存最长60秒)
+    在全部重试期间都处于SigV4允许的5分钟时间窗口内
+    """
+    
+    # 单次重试遵循Retry-After的最长等待时间(秒)
+    MAX_RETRY_AFTER = 30
+    
+    def __init__(self, *args, on_throttle=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_throttle = on_throttle
+    
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.on_throttle = self.on_throttle
+        return retry
+    
+    def get_backoff_time(self):
+        # 带抖动的指数退避，避免多个客户端同时重试
+        backoff = super().get_backoff_time()
+        return backoff * random.uniform(0.5, 1.0)
+    
+    def parse_retry_after(self, retry_after):
+        return min(super().parse_retry_after(retry_after), self.MAX_RETRY_AFTER)
+    
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if method == 'POST' and isinstance(error, (ReadTimeoutError, ProtocolError)):
+            raise error
+        if response is not None and response.status == 429 and self.on_throttle is not None:
+            self.on_throttle()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+@dataclass
+class Resp:
+    """EMR Serverless响应，JSON响应体只解析一次"""
+    status_code: int
+    headers: dict
+    content: bytes
+    
+    def __bool__(self):
+        return self.status_code < 400
+    
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+    
+    def preview(self, limit=512):
+        """返回响应体的前limit个字节，用于错误日志"""
+        return self.content[:limit].decode('utf-8', 'replace')
+    
+    @cached_property
+    def json_obj(self):
+        return _json_loads(self.content)
+
+
 class EMRServerlessClient:
+    # 批量提交时用于分隔各语句输出的标记
+    STATEMENT_SEPARATOR = '---SEP---'
+    # 允许在后台继续执行的落败对冲请求数量上限
+    MAX_HEDGE_STRAGGLERS = 2
+    
     def __init__(self, application_id, region, role_arn, timeout=300):
         """
         初始化EMR Serverless客户端
@@ -24,78 +170,273 @@ class EMRServerlessClient:
         """
         self.endpoint = f'https://{application_id}.livy.emr-serverless-services.{region}.amazonaws.com'
         self.headers = {'Content-Type': 'application/json'}
+        # 预先计算Host头，签名时无需再从URL解析
+        self._base_headers = dict(self.headers, Host=urlparse(self.endpoint).netloc)
+        # 轮询GET请求的签名缓存: (url, 分钟桶) -> (url, headers)
+        self._signed_get_cache = {}
+        # GET响应的短时缓存: (method, url) -> (response, 过期时间)
+        self._response_cache = {}
+        self._response_cache_ttl = 1.0
+        self._response_cache_size = 32
+        # 最近是否收到限流响应，限流期间不发送对冲请求
+        self._throttled = False
+        # 服务端限流响应头的最新状态: {'remaining': 剩余配额, 'reset_at': 配额重置时间戳}
+        self._rl_state = {'remaining': None, 'reset_at': None}
+        # 对冲请求线程池: 主请求和对冲请求各一个线程，其余留给仍在后台执行的落败请求
+        self._hedge_executor = ThreadPoolExecutor(max_workers=2 + self.MAX_HEDGE_STRAGGLERS)
+        self._hedge_stragglers = set()
+        self._hedge_local = threading.local()
         self.role_arn = role_arn
         self.timeout = timeout
+        # 单次HTTP请求的(连接, 读取)超时，避免端点无响应时永久阻塞
+        self.request_timeout = (5, 30)
         self.session_url = None
         
+        # 复用连接池，避免每次轮询都重新进行TCP+TLS握手
+        # 对限流和服务端错误的重试(带抖动的指数退避，遵循Retry-After)交给urllib3完成
+        # 收到429时立即标记限流，避免urllib3重试期间_hedged_get再发送对冲请求
+        # POST请求发出后的读取错误不重试，避免重复创建会话或重复执行语句
+        retry = ThrottleAwareRetry(
+            total=3,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET', 'POST', 'DELETE'],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            on_throttle=self._on_throttle
+        )
+        self.http = requests.Session()
+        self.http.mount('https://', KeepAliveHTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry))
+        
         # 初始化AWS会话和签名器
         try:
-            session = botocore.session.Session()
-            self.signer = crt.auth.CrtS3SigV4Auth(session.get_credentials(), 'emr-serverless', region)
+            # 签名器和凭证在进程内按区域共享，避免每个客户端重新遍历凭证提供链
+            self.signer = _get_signer(region)
             logger.info(f"已初始化EMR Serverless客户端，端点: {self.endpoint}")
         except Exception as e:
             logger.error(f"初始化失败: {str(e)}")
+            self.close()
             raise
     
-    def _send_request(self, method, path, data=None, max_retries=3):
-        """发送已签名的请求到EMR Serverless"""
+    def close(self):
+        """关闭对冲请求线程池和底层HTTP连接池，会等待仍在执行的落败对冲请求结束"""
+        self._hedge_executor.shutdown(wait=True, cancel_futures=True)
+        self.http.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _sign_request(self, method, url, body=None):
+        """
+        对请求进行SigV4签名
+        
+        同一分钟内对相同URL的GET请求复用已签名的请求头，x-amz-date
+        始终处于SigV4允许的时钟偏差窗口内，轮询时可省去重复的签名计算
+        
+        返回:
+            (签名后的URL, 签名后的请求头)
+        """
+        cache_key = None
+        if method == 'GET':
+            minute_bucket = int(time.time() // 60)
+            cache_key = (url, minute_bucket)
+            cached = self._signed_get_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            # 清理过期分钟桶中的签名
+            for key in list(self._signed_get_cache):
+                if key[1] != minute_bucket:
+                    self._signed_get_cache.pop(key, None)
+        
+        request = AWSRequest(
+            method=method, 
+            url=url, 
+            data=body, 
+            headers=dict(self._base_headers)
+        )
+        self.signer.add_auth(request)
+        prepped = request.prepare()
+        signed = (prepped.url, prepped.headers)
+        
+        if cache_key is not None:
+            self._signed_get_cache[cache_key] = signed
+        return signed
+    
+    def _cache_response(self, cache_key, response):
+        """缓存成功的GET响应，超出容量时淘汰最早的条目"""
+        self._response_cache.pop(cache_key, None)
+        self._response_cache[cache_key] = (response, time.monotonic() + self._response_cache_ttl)
+        while len(self._response_cache) > self._response_cache_size:
+            self._response_cache.pop(next(iter(self._response_cache)), None)
+    
+    def _send_request(self, method, path, data=None, use_cache=True):
+        """
+        发送已签名的请求到EMR Serverless
+        
+        参数:
+            use_cache: GET请求是否读写短时响应缓存，状态轮询需传False以获取最新状态
+        """
         url = f"{self.endpoint}{path}"
         logger.info(f"发送{method}请求: {url}")
         
-        if data:
-            logger.debug(f"请求数据: {json.dumps(data, indent=2)}")
+        if data and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("请求数据: %s", _json_dumps_pretty(data))
+        
+        # 请求体只序列化一次，签名和发送共用
+        body = _json_dumps(data) if data is not None else None
+        
+        cache_key = (method, url)
+        if method == 'GET':
+            cached = self._response_cache.get(cache_key) if use_cache else None
+            if cached is not None:
+                response, expiry = cached
+                if time.monotonic() < expiry:
+                    logger.info(f"命中响应缓存: {url}")
+                    # 返回新的Resp，避免调用方修改解析结果时污染缓存
+                    return Resp(response.status_code, response.headers, response.content)
+                self._response_cache.pop(cache_key, None)
+        else:
+            # 写操作会改变服务端状态，清空全部缓存
+            self._response_cache.clear()
+        
+        if method not in ('GET', 'POST', 'DELETE'):
+            raise ValueError(f"不支持的HTTP方法: {method}")
+        
+        # 创建并签名请求，重试由连接池适配器在urllib3层完成并复用同一签名
+        signed_url, signed_headers = self._sign_request(method, url, body)
+        response = self._perform_request(method, signed_url, signed_headers, body)
+        return self._record_response(method, cache_key, response, use_cache)
+    
+    def _perform_request(self, method, signed_url, signed_headers, body=None):
+        """发送已签名的请求，只进行网络I/O，不修改客户端状态"""
+        try:
+            # 发送请求(通过共享的连接池)
+            response = self.http.request(
+                method,
+                signed_url,
+                headers=signed_headers,
+                data=body,
+                timeout=self.request_timeout
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"请求异常: {str(e)}")
+            raise
+        return Resp(response.status_code, response.headers, response.content)
+    
+    def _record_response(self, method, cache_key, response, use_cache):
+        """根据响应更新限流状态和响应缓存"""
+        self._update_rate_limit_state(response.headers)
         
-        retry_count = 0
-        while retry_count < max_retries:
+        # 检查响应
+        if 200 <= response.status_code < 300:
+            logger.info(f"请求成功，状态码: {response.status_code}")
+            self._throttled = False
+            if method == 'GET' and use_cache:
+                self._cache_response(cache_key, response)
+        else:
+            logger.error(f"请求失败，状态码: {response.status_code}, 响应: {response.preview()}")
+            if response.status_code == 429:
+                self._throttled = True
+        return response
+    
+    def _on_throttle(self):
+        """urllib3在重试429响应前的回调"""
+        # 已决出结果的对冲请求中落败的一方不再修改限流状态
+        settled = getattr(self._hedge_local, 'settled', None)
+        if settled is not None and settled.is_set():
+            return
+        self._throttled = True
+    
+    def _update_rate_limit_state(self, headers):
+        """从响应头(*-RateLimit-Remaining/*-RateLimit-Reset/Retry-After)中记录限流状态"""
+        remaining = None
+        reset_at = None
+        now = time.time()
+        for name, value in headers.items():
+            name = name.lower()
             try:
-                # 创建并签名请求
-                request = AWSRequest(
-                    method=method, 
-                    url=url, 
-                    data=json.dumps(data) if data else None, 
-                    headers=self.headers
-                )
-                request.context["payload_signing_enabled"] = False
-                self.signer.add_auth(request)
-                prepped = request.prepare()
-                
-                # 发送请求
-                if method == 'GET':
-                    response = requests.get(prepped.url, headers=prepped.headers)
-                elif method == 'POST':
-                    response = requests.post(prepped.url, headers=prepped.headers, data=json.dumps(data) if data else None)
-                elif method == 'DELETE':
-                    response = requests.delete(prepped.url, headers=prepped.headers)
-                else:
-                    raise ValueError(f"不支持的HTTP方法: {method}")
-                
-                # 检查响应
-                if 200 <= response.status_code < 300:
-                    logger.info(f"请求成功，状态码: {response.status_code}")
-                    return response
-                else:
-                    logger.error(f"请求失败，状态码: {response.status_code}, 响应: {response.text}")
-                    # 对于某些错误码可能需要重试
-                    if response.status_code in [429, 500, 502, 503, 504]:
-                        retry_count += 1
-                        wait_time = 2 ** retry_count  # 指数退避
-                        logger.info(f"等待{wait_time}秒后重试...")
-                        time.sleep(wait_time)
-                        continue
-                    return response
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"请求异常: {str(e)}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = 2 ** retry_count
-                    logger.info(f"等待{wait_time}秒后重试...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"达到最大重试次数({max_retries})，放弃请求")
-                    raise
+                if name.endswith('ratelimit-remaining'):
+                    remaining = int(value)
+                elif name.endswith('ratelimit-reset'):
+                    reset = float(value)
+                    # 可能是毫秒或秒级Unix时间戳，也可能是距重置的秒数
+                    if reset > 1e12:
+                        reset /= 1000
+                    reset_at = reset if reset > 1e9 else now + reset
+                elif name == 'retry-after':
+                    remaining = 0
+                    reset_at = now + float(value)
+            except ValueError:
+                continue
         
-        return None
+        # 响应中没有限流信息时清除旧状态，避免持续放慢轮询
+        self._rl_state = {'remaining': remaining, 'reset_at': reset_at}
+        if remaining is not None and remaining < 5:
+            reset_in = f"{reset_at - now:.1f}秒后" if reset_at is not None else "未知"
+            logger.warning(f"接近服务端限流: 剩余配额{remaining}，配额重置时间: {reset_in}")
+    
+    def _rate_limited_delay(self, delay):
+        """根据最近的限流状态调整轮询等待时间"""
+        remaining = self._rl_state['remaining']
+        reset_at = self._rl_state['reset_at']
+        if remaining is None:
+            return delay
+        if remaining == 0 and reset_at is not None:
+            return max(delay, reset_at - time.time())
+        if remaining < 5:
+            return delay * 2
+        return delay
+    
+    def _hedged_get(self, path, hedge_delay=0.5):
+        """
+        发送带对冲的幂等GET请求
+        
+        若请求在hedge_delay秒内未返回，则用同一签名再发送一个相同的请求，
+        取先成功返回的结果，以缩短轮询的长尾延迟。每次最多对冲一次，限流期间
+        或后台仍有过多未完成的落败请求时不对冲。
+        
+        后台线程只负责网络I/O，限流状态和缓存只由调用线程根据胜出的响应更新。
+        落败的请求若尚未开始则被取消，已在执行的请求会在后台完成，其结果被丢弃
+        """
+        url = f"{self.endpoint}{path}"
+        logger.info(f"发送GET请求: {url}")
+        signed_url, signed_headers = self._sign_request('GET', url)
+        settled = threading.Event()
+        
+        primary = self._hedge_executor.submit(self._hedge_fetch, settled, signed_url, signed_headers)
+        pending = {primary}
+        wait(pending, timeout=hedge_delay)
+        
+        self._hedge_stragglers = {f for f in self._hedge_stragglers if not f.done()}
+        if (not primary.done() and not self._throttled
+                and len(self._hedge_stragglers) < self.MAX_HEDGE_STRAGGLERS):
+            logger.info(f"请求超过{hedge_delay}秒未返回，发送对冲请求...")
+            pending.add(self._hedge_executor.submit(self._hedge_fetch, settled, signed_url, signed_headers))
+        
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in done if f.exception() is None), None)
+        
+        settled.set()
+        for loser in pending:
+            if not loser.cancel():
+                self._hedge_stragglers.add(loser)
+        
+        # 全部请求都失败时抛出原始请求的异常
+        response = winner.result() if winner is not None else primary.result()
+        return self._record_response('GET', ('GET', url), response, use_cache=False)
+    
+    def _hedge_fetch(self, settled, signed_url, signed_headers):
+        """在对冲线程池中发送GET请求"""
+        self._hedge_local.settled = settled
+        try:
+            return self._perform_request('GET', signed_url, signed_headers)
+        finally:
+            self._hedge_local.settled = None
     
     def create_session(self):
         """创建一个新的Spark会话"""
@@ -111,7 +452,7 @@ class EMRServerlessClient:
         
         response = self._send_request('POST', "/sessions", data)
         if not response or response.status_code >= 300:
-            raise Exception(f"创建会话失败: {response.text if response else '无响应'}")
+            raise Exception(f"创建会话失败: {response.preview() if response else '无响应'}")
         
         # 保存会话URL
         self.session_url = response.headers.get('location')
@@ -119,7 +460,58 @@ class EMRServerlessClient:
             raise Exception("响应中没有会话位置信息")
         
         logger.info(f"会话创建成功，位置: {self.session_url}")
-        return response.json()
+        return response.json_obj
+    
+    def _poll(self, get_fn, terminal_states, initial=0.5, cap=5, factor=1.5, max_cap=30):
+        """
+        按指数退避+随机抖动轮询状态，直到进入终止状态或超时
+        
+        参数:
+            get_fn: 获取当前状态的函数，返回响应数据(dict)或None
+            terminal_states: 终止状态集合
+            initial: 初始等待时间(秒)
+            cap: 等待时间上限(秒)，状态长时间不变时逐步放宽
+            factor: 退避增长系数
+            max_cap: 等待时间上限的最大值(秒)
+        
+        返回:
+            进入终止状态时的响应数据，超时返回None
+        """
+        start_time = time.time()
+        base_cap = cap
+        attempt = 0
+        last_state = None
+        
+        while time.time() - start_time < self.timeout:
+            data = get_fn()
+            state = data.get('state', 'unknown') if data is not None else None
+            
+            if state in terminal_states:
+                return data
+            
+            # 状态发生变化说明有进展，重置退避
+            if state is not None and state != last_state:
+                attempt = 0
+                cap = base_cap
+                last_state = state
+            
+            delay = initial * factor ** attempt
+            # 指数部分超过max_cap后不再增长，避免长时间运行的语句导致浮点溢出
+            if delay < max_cap:
+                attempt += 1
+            if delay >= cap:
+                # 已达到上限且状态未变化，放宽上限以减少无效轮询
+                delay = cap
+                cap = min(max_cap, cap * factor)
+            delay *= random.uniform(0.5, 1.5)
+            # 限流等待可能很长，不超过max_cap且不超过剩余的超时时间
+            delay = self._rate_limited_delay(delay)
+            delay = max(0.0, min(delay, max_cap, start_time + self.timeout - time.time()))
+            
+            logger.info(f"当前状态: {state}，等待{delay:.2f}秒...")
+            time.sleep(delay)
+        
+        return None
     
     def wait_for_session_ready(self, poll_interval=5):
         """等待会话变为就绪状态"""
@@ -127,29 +519,28 @@ class EMRServerlessClient:
             raise Exception("没有活动的会话")
         
         logger.info("等待会话就绪...")
-        start_time = time.time()
         
-        while time.time() - start_time < self.timeout:
-            response = self._send_request('GET', self.session_url)
+        def get_session():
+            try:
+                response = self._send_request('GET', self.session_url, use_cache=False)
+            except requests.exceptions.RequestException:
+                response = None
             if not response:
                 logger.error("获取会话状态失败")
-                time.sleep(poll_interval)
-                continue
-                
-            session_state = response.json().get('state', 'unknown')
-            logger.info(f"当前会话状态: {session_state}")
-            
-            if session_state == 'idle':
-                logger.info("会话已就绪")
-                return True
-            elif session_state in ['error', 'dead', 'killed']:
-                logger.error(f"会话进入错误状态: {session_state}")
-                return False
-                
-            logger.info(f"会话尚未就绪，等待{poll_interval}秒...")
-            time.sleep(poll_interval)
-        
-        logger.error(f"等待会话就绪超时({self.timeout}秒)")
+                return None
+            return response.json_obj
+        
+        session_data = self._poll(get_session, {'idle', 'error', 'dead', 'killed'}, cap=poll_interval)
+        if session_data is None:
+            logger.error(f"等待会话就绪超时({self.timeout}秒)")
+            return False
+        
+        session_state = session_data.get('state')
+        if session_state == 'idle':
+            logger.info("会话已就绪")
+            return True
+        
+        logger.error(f"会话进入错误状态: {session_state}")
         return False
     
     def list_sessions(self):
@@ -159,7 +550,7 @@ class EMRServerlessClient:
         if not response or response.status_code >= 300:
             logger.error("获取会话列表失败")
             return None
-        return response.json()
+        return response.json_obj
     
     def submit_statement(self, code):
         """提交代码语句到会话"""
@@ -173,43 +564,113 @@ class EMRServerlessClient:
         response = self._send_request('POST', statements_url, data)
         
         if not response or response.status_code >= 300:
-            raise Exception(f"提交语句失败: {response.text if response else '无响应'}")
+            raise Exception(f"提交语句失败: {response.preview() if response else '无响应'}")
             
         statement_location = response.headers.get('location')
         if not statement_location:
             raise Exception("响应中没有语句位置信息")
             
         logger.info(f"语句提交成功，位置: {statement_location}")
-        return statement_location, response.json()
+        return statement_location, response.json_obj
+    
+    def submit_statements(self, codes):
+        """
+        将多个语句合并为一次提交
+        
+        每个语句前输出分隔标记，并在各自的try/except中执行，某个语句失败时
+        其异常信息输出在该语句的分隔标记之后，不影响其余语句执行。结果可通过
+        split_statement_output按语句拆分。语句通过exec执行，表达式的值不会
+        被回显，需要显式print
+        
+        参数:
+            codes: 代码语句列表
+        
+        返回:
+            (语句位置, 提交响应)
+        """
+        lines = ['import sys as _livy_sys, traceback as _livy_traceback']
+        for index, c in enumerate(codes):
+            snippet = textwrap.dedent(c).strip()
+            lines.append(f"print({self.STATEMENT_SEPARATOR!r})")
+            lines.append('try:')
+            lines.append(f"    exec(compile({snippet!r}, '<statement {index}>', 'exec'), globals())")
+            lines.append('except Exception:')
+            lines.append('    _livy_traceback.print_exc(file=_livy_sys.stdout)')
+        return self.submit_statement('\n'.join(lines))
+    
+    def split_statement_output(self, statement_data):
+        """
+        按分隔标记拆分submit_statements提交的语句输出
+        
+        返回:
+            各语句的文本输出列表(失败语句为其异常信息)，整体执行失败或无文本输出时返回None
+        """
+        output = (statement_data or {}).get('output') or {}
+        if output.get('status') != 'ok':
+            return None
+        text = output.get('data', {}).get('text/plain')
+        if text is None:
+            return None
+        return [part.lstrip('\n') for part in text.split(self.STATEMENT_SEPARATOR)[1:]]
     
     def get_statement_result(self, statement_location, poll_interval=2):
         """获取语句执行结果，等待直到完成"""
         logger.info("等待语句执行完成...")
-        start_time = time.time()
         
-        while time.time() - start_time < self.timeout:
-            response = self._send_request('GET', statement_location)
+        def get_statement():
+            try:
+                response = self._hedged_get(statement_location)
+            except requests.exceptions.RequestException:
+                response = None
             if not response:
                 logger.error("获取语句状态失败")
-                time.sleep(poll_interval)
-                continue
-                
-            statement_data = response.json()
-            statement_state = statement_data.get('state', 'unknown')
-            logger.info(f"当前语句状态: {statement_state}")
-            
-            if statement_state == 'available':
-                logger.info("语句执行完成")
-                return statement_data
-            elif statement_state in ['error', 'cancelled']:
-                logger.error(f"语句执行失败: {statement_state}")
-                return statement_data
-                
-            logger.info(f"语句执行中，等待{poll_interval}秒...")
-            time.sleep(poll_interval)
-        
-        logger.error(f"等待语句执行超时({self.timeout}秒)")
-        return None
+                return None
+            return response.json_obj
+        
+        statement_data = self._poll(get_statement, {'available', 'error', 'cancelled'}, cap=poll_interval)
+        if statement_data is None:
+            logger.error(f"等待语句执行超时({self.timeout}秒)")
+            return None
+        
+        statement_state = statement_data.get('state')
+        if statement_state == 'available':
+            logger.info("语句执行完成")
+        else:
+            logger.error(f"语句执行失败: {statement_state}")
+        return statement_data
+    
+    def run_statements(self, codes):
+        """
+        连续提交多个语句，再依次获取执行结果
+        
+        Livy在同一会话内按顺序执行语句，提前提交后续语句可以让它们在
+        等待前一个语句结果的同时排队执行，总耗时接近各语句执行时间之和
+        而无需额外的提交和轮询间隔
+        
+        参数:
+            codes: 代码语句列表
+        
+        某个语句提交失败时不再提交其后的语句，但仍会获取已提交语句的结果
+        
+        参数:
+            codes: 代码语句列表
+        
+        返回:
+            与codes顺序一致的(提交响应, 执行结果)列表，未提交成功的语句为(None, None)
+        """
+        submitted = []
+        for code in codes:
+            try:
+                submitted.append(self.submit_statement(code))
+            except Exception as e:
+                logger.error(f"提交语句失败，后续语句不再提交: {str(e)}")
+                break
+        
+        results = [
+            (statement_info, self.get_statement_result(statement_location))
+            for statement_location, statement_info in submitted
+        ]
+        return results + [(None, None)] * (len(codes) - len(results))
     
     def delete_session(self):
         """删除当前会话"""
@@ -221,7 +682,7 @@ class EMRServerlessClient:
         response = self._send_request('DELETE', self.session_url)
         
         if not response or response.status_code >= 300:
-            logger.error(f"删除会话失败: {response.text if response else '无响应'}")
+            logger.error(f"删除会话失败: {response.preview() if response else '无响应'}")
             return False
             
         logger.info("会话删除成功")
@@ -243,7 +704,7 @@ def main():
         # 创建会话
         session_info = client.create_session()
         print("\n=== 创建的会话信息 ===")
-        pprint.pprint(session_info)
+        print(_json_dumps_pretty(session_info))
         
         # 等待会话就绪
         if not client.wait_for_session_ready():
@@ -254,36 +715,32 @@ def main():
         # 列出会话
         sessions = client.list_sessions()
         print("\n=== 会话列表 ===")
-        pprint.pprint(sessions)
+        print(_json_dumps_pretty(sessions))
         
-        # 提交简单计算
-        statement_location, statement_info = client.submit_statement("1 + 1")
-        print("\n=== 提交的语句信息 ===")
-        pprint.pprint(statement_info)
-        
-        # 获取结果
-        result = client.get_statement_result(statement_location)
-        print("\n=== 语句执行结果 ===")
-        pprint.pprint(result)
-        
-        # 提交更复杂的计算
-        statement_location, _ = client.submit_statement("""
+        # 连续提交简单计算和更复杂的计算，再依次获取结果
+        (statement_info, result), (_, complex_result) = client.run_statements([
+            "1 + 1",
+            """
         data = [2, 2, 4, 8, 8, 8, 8, 16, 32, 32]
         rdd = sc.parallelize(data)
-        """)
-        
-        # 获取结果
-        result = client.get_statement_result(statement_location)
+        """
+        ])
+        print("\n=== 提交的语句信息 ===")
+        print(_json_dumps_pretty(statement_info))
+        print("\n=== 语句执行结果 ===")
+        print(_json_dumps_pretty(result))
         print("\n=== 复杂语句执行结果 ===")
-        pprint.pprint(result)
+        print(_json_dumps_pretty(complex_result))
         
     except Exception as e:
         print(f"错误: {str(e)}")
     finally:
         # 确保会话被删除
-        if 'client' in locals() and client.session_url:
-            client.delete_session()
-            print("已清理会话资源")
+        if 'client' in locals():
+            if client.session_url:
+                client.delete_session()
+                print("已清理会话资源")
+            client.close()
 
 
 if __name__ == "__main__":